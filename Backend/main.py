@@ -2,11 +2,11 @@ import os
 import json
 import tempfile
 import sqlite3
-import re
 from fastapi import FastAPI, UploadFile, File, Form, Body
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
-from processor import DocumentProcessor, sanitize_for_json
+from processor import DocumentProcessor, format_schema, load_json_safe
 from typing import List, Dict, Any
 
 load_dotenv()
@@ -23,33 +23,127 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# === Initialize OCI-powered DocumentProcessor ===
-processor = DocumentProcessor(config_file="config.ini", profile="DEFAULT")
-
 # === SQLite setup ===
 DB_PATH = "documents.db"
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-cur = conn.cursor()
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS documents (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    filename TEXT,
-    file_type TEXT,
-    client_name TEXT,
-    language TEXT,
-    layout TEXT,       -- JSON array of columns
-    user_prompt TEXT,  -- saved prompt if any
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-)
-""")
-conn.commit()
+
+
+def init_db():
+    """Open the SQLite database, creating the documents table and its indexes."""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    cur = conn.cursor()
+    # WAL + synchronous=NORMAL: each per-upload commit appends to the log instead of
+    # fsyncing the main database file; checkpoints batch the writes back
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS documents (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        filename TEXT,
+        file_type TEXT,
+        client_name TEXT,
+        language TEXT,
+        layout TEXT,       -- JSON array of columns
+        user_prompt TEXT,  -- saved prompt if any
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    # Client lookups (client_exists check, exact-match prompt) and the saved-prompt
+    # candidate scan in find_suggested_prompt would otherwise scan the whole table
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_documents_client_name ON documents (client_name)")
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_documents_prompted
+    ON documents (client_name) WHERE user_prompt IS NOT NULL
+    """)
+    conn.commit()
+    return conn, cur
+
+
+# === Initialize OCI-powered DocumentProcessor + SQLite ===
+# With `python main.py`, spawned Docling workers re-import this file as __mp_main__.
+# They only need processor.py, so they skip the app's processor and database.
+if __name__ != "__mp_main__":
+    processor = DocumentProcessor(config_file="config.ini", profile="DEFAULT")
+    conn, cur = init_db()
+
+
+@app.on_event("startup")
+def warmup_processor():
+    """Load Docling models before the first upload arrives."""
+    processor.warmup()
+
+
+@app.on_event("shutdown")
+def close_processor():
+    """Stop the Docling worker processes."""
+    processor.close()
 
 
 def get_file_type(filename):
-    """Extract file type from filename using regex (e.g. pdf, xlsx)."""
-    match = re.search(r'\.([^.]+)$', filename)
-    return match.group(1).lower() if match else None
+    """Extract file type from filename (e.g. pdf, xlsx)."""
+    _, dot, ext = filename.rpartition(".")
+    return ext.lower() if dot and ext else None
+
+
+# Uploads are copied to disk in 1 MB chunks so large files never sit in memory whole
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Temp dir for uploads (default: system temp dir). Set UPLOAD_TMP_DIR=/dev/shm to keep
+# them in RAM so Docling's read skips disk, if it is large enough for concurrent uploads
+UPLOAD_TMP_DIR = os.environ.get("UPLOAD_TMP_DIR") or None
+
+
+async def save_upload(file: UploadFile) -> str:
+    """Stream an uploaded file into a temp file and return its path."""
+    with tempfile.NamedTemporaryFile(delete=False, dir=UPLOAD_TMP_DIR) as tmp:
+        try:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                tmp.write(chunk)
+        except BaseException:
+            # Client disconnect, full temp dir, ...: don't leave the partial file behind
+            os.unlink(tmp.name)
+            raise
+        return tmp.name
+
+
+async def extract_with_suggested_prompt(structured_markdown, metadata, schema):
+    """Look up a saved prompt for the document's client/layout and extract schema JSON with it."""
+    # Own cursor: find_suggested_prompt runs in a worker thread
+    suggested_prompt = await run_in_threadpool(
+        processor.find_suggested_prompt,
+        current_client=metadata["client_name"],
+        current_layout=metadata["layout"],
+        cursor=conn.cursor()
+    )
+
+    generated_json, output_tokens = await run_in_threadpool(
+        processor.extract_json_with_schema,
+        structured_markdown,
+        schema,
+        suggested_prompt
+    )
+    return suggested_prompt, generated_json, output_tokens
+
+
+def store_document(filename, metadata):
+    """Insert a processed document into SQLite and return its id."""
+    cur.execute(
+        """
+        INSERT INTO documents (filename, file_type, client_name, language, layout, user_prompt)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        (
+            filename,
+            get_file_type(filename),
+            metadata["client_name"],
+            metadata["language"],
+            json.dumps(metadata["layout"]),
+            None
+        ),
+    )
+    doc_id = cur.lastrowid
+    conn.commit()
+    return doc_id
 
 
 # === Upload + Process Document ===
@@ -60,57 +154,31 @@ async def process_document(file: UploadFile = File(...), schema_json: str = Form
         # Add FileName to schema
         schema["FileName"] = ""
 
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-            tmp.write(await file.read())
-            tmp_path = tmp.name
+        tmp_path = await save_upload(file)
 
-        # Run processor
-        result = processor.process_document(tmp_path)
+        # Run processor (Docling/OCI block, so keep them off the event loop)
+        try:
+            result = await run_in_threadpool(processor.process_document, tmp_path, file.filename)
+        finally:
+            # Only Docling needs the file; don't let uploads pile up in the temp dir
+            os.unlink(tmp_path)
         structured_markdown = result["structured_markdown"]
         metadata = result["metadata"]
 
-        # Get suggested prompt before extraction
-        suggested_prompt = processor.find_suggested_prompt(
-            current_client=metadata["client_name"],
-            current_layout=metadata["layout"],
-            cursor=cur
-        )
-
-        # Use suggested prompt in extraction
-        generated_json, output_tokens = processor.extract_json_with_schema(
-            structured_markdown,
-            schema,
-            suggested_prompt
+        suggested_prompt, generated_json, output_tokens = await extract_with_suggested_prompt(
+            structured_markdown, metadata, schema
         )
         # Add filename to generated JSON
         generated_json["FileName"] = file.filename
 
-        # Store document in SQLite
-        file_type = get_file_type(file.filename)
-        cur.execute(
-            """
-            INSERT INTO documents (filename, file_type, client_name, language, layout, user_prompt)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (
-                file.filename,
-                file_type,
-                metadata["client_name"],
-                metadata["language"],
-                json.dumps(metadata["layout"]),
-                None
-            ),
-        )
-        doc_id = cur.lastrowid
-        conn.commit()
-        print(generated_json)
+        doc_id = store_document(file.filename, metadata)
 
         return {
             "status": "success",
             "document_id": doc_id,
             "filename": file.filename,
             "structured_markdown": structured_markdown,
-            "generated_json": sanitize_for_json(generated_json),
+            "generated_json": generated_json,
             "suggested_prompt": suggested_prompt,
             "oci_output_tokens": output_tokens,
         }
@@ -121,24 +189,28 @@ async def process_document(file: UploadFile = File(...), schema_json: str = Form
         return {"status": "error", "message": str(e)}
 
 @app.post("/inference-document/")
-async def process_document(file: UploadFile = File(...), schema_json: str = Form(...)):
+async def inference_document(file: UploadFile = File(...), schema_json: str = Form(...)):
     try:
         schema = json.loads(schema_json)
         # Add FileName to schema
         schema["FileName"] = ""
 
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-            tmp.write(await file.read())
-            tmp_path = tmp.name
+        tmp_path = await save_upload(file)
 
         # Run processor
-        result = processor.process_document(tmp_path)
+        try:
+            result = await run_in_threadpool(processor.process_document, tmp_path, file.filename)
+        finally:
+            os.unlink(tmp_path)
         structured_markdown = result["structured_markdown"]
         metadata = result["metadata"]
 
         # Check if client name exists in database
-        cur.execute("SELECT COUNT(*) FROM documents WHERE client_name = ?", (metadata["client_name"],))
-        client_exists = cur.fetchone()[0] > 0
+        cur.execute(
+            "SELECT EXISTS(SELECT 1 FROM documents WHERE client_name = ?)",
+            (metadata["client_name"],)
+        )
+        client_exists = bool(cur.fetchone()[0])
         
         if not client_exists:
             return {
@@ -146,47 +218,20 @@ async def process_document(file: UploadFile = File(...), schema_json: str = Form
                 "message": "We don't have configurations setup for this type of layout. Please Configure it"
             }
 
-        # Get suggested prompt before extraction
-        suggested_prompt = processor.find_suggested_prompt(
-            current_client=metadata["client_name"],
-            current_layout=metadata["layout"],
-            cursor=cur
-        )
-
-        # Use suggested prompt in extraction
-        generated_json, output_tokens = processor.extract_json_with_schema(
-            structured_markdown,
-            schema,
-            suggested_prompt
+        suggested_prompt, generated_json, output_tokens = await extract_with_suggested_prompt(
+            structured_markdown, metadata, schema
         )
         # Add filename to generated JSON
         generated_json["FileName"] = file.filename
 
-        # Store document in SQLite
-        file_type = get_file_type(file.filename)
-        cur.execute(
-            """
-            INSERT INTO documents (filename, file_type, client_name, language, layout, user_prompt)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (
-                file.filename,
-                file_type,
-                metadata["client_name"],
-                metadata["language"],
-                json.dumps(metadata["layout"]),
-                None
-            ),
-        )
-        doc_id = cur.lastrowid
-        conn.commit()
+        doc_id = store_document(file.filename, metadata)
 
         return {
             "status": "success",
             "document_id": doc_id,
             "filename": file.filename,
             "structured_markdown": structured_markdown,
-            "extracted_data": sanitize_for_json(generated_json),
+            "extracted_data": generated_json,
             "suggested_prompt": suggested_prompt,
             "oci_output_tokens": output_tokens,
         }
@@ -205,22 +250,24 @@ async def try_prompt(
 ):
     try:
         schema = json.loads(schema_json)
+        schema_str, _ = format_schema(schema)
 
         custom_prompt = f"""
         Instruction: {user_prompt}
         Document: {document}
         Extract data into JSON with this schema:
-        {json.dumps(schema, indent=2)}
+        {schema_str}
         """
-        raw_json, output_tokens = processor._call_oci_llm(custom_prompt)
+        raw_json, output_tokens = await run_in_threadpool(processor._call_oci_llm, custom_prompt)
         try:
-            parsed_json = json.loads(raw_json)
+            parsed_json = load_json_safe(raw_json)
         except:
+            processor._forget_llm_reply(custom_prompt)
             parsed_json = {"error": "Failed to parse JSON", "raw": raw_json}
 
         return {
             "status": "success",
-            "generated_json": sanitize_for_json(parsed_json),
+            "generated_json": parsed_json,
             "oci_output_tokens": output_tokens,
         }
 
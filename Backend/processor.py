@@ -2,42 +2,158 @@ import os
 import re
 import json
 import math
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
 from pathlib import Path
 from typing import Dict, Any, Tuple
 import oci
 from docling.datamodel.base_models import InputFormat
 from docling.datamodel.pipeline_options import (
+    AcceleratorOptions,
     PdfPipelineOptions,
     TesseractCliOcrOptions,
 )
 from docling.document_converter import DocumentConverter, PdfFormatOption
 
 
-def sanitize_for_json(data):
-    """Ensure all values are JSON serializable."""
-    if isinstance(data, float):
-        if math.isnan(data) or math.isinf(data):
-            return "NaN"
-        return data
-    elif isinstance(data, dict):
-        return {str(k): sanitize_for_json(v) for k, v in data.items()}
-    elif isinstance(data, list):
-        return [sanitize_for_json(v) for v in data]
-    else:
-        try:
-            json.dumps(data)
-            return data
-        except Exception:
-            return str(data)
+# Strips the extension for the client_name fallback, compiled once
+_STRIP_EXT_RE = re.compile(r"\..*$")
+
+# Max OCI replies kept in memory; calls use temperature 0, so a prompt's reply is reusable
+LLM_CACHE_SIZE = 512
+
+
+def _parse_finite_float(text: str):
+    value = float(text)
+    return value if math.isfinite(value) else "NaN"
+
+
+_JSON_DECODER = json.JSONDecoder(parse_float=_parse_finite_float, parse_constant=lambda _: "NaN")
+
+
+def load_json_safe(text: str):
+    """
+    Parse the first JSON object/array in an LLM reply, stopping at its closing bracket
+    so code fences or trailing text don't matter. NaN/Infinity become "NaN" so the
+    result is always JSON serializable.
+    """
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if not starts:
+        raise ValueError("No JSON found in response")
+    value, _ = _JSON_DECODER.raw_decode(text, min(starts))
+    return value
+
+def _normalize_layout(layout) -> frozenset:
+    """Layout column names, compared ignoring case, extra whitespace and order."""
+    if not isinstance(layout, list):
+        return frozenset()
+    return frozenset(" ".join(str(column).split()).casefold() for column in layout)
+
+
+@lru_cache(maxsize=128)
+def _format_schema(schema_key: str) -> Tuple[str, str]:
+    schema = json.loads(schema_key)
+    # /try-prompt/ accepts any JSON schema; only an object has fields to sample
+    sample_json = {key: "" for key in schema} if isinstance(schema, dict) else {}
+    return json.dumps(schema, indent=2), json.dumps(sample_json, indent=2)
+
+
+def format_schema(schema: Any) -> Tuple[str, str]:
+    """
+    Return the schema and an empty-valued sample of it as indented JSON for prompts.
+    indent=2 forces json's pure-Python encoder, so results are cached per schema,
+    keyed by the compact (C-encoded) dump.
+    """
+    return _format_schema(json.dumps(schema))
 
 def get_file_type(filename: str) -> str:
-    """Extract file type (extension) using regex, e.g., pdf, xlsx, docx."""
-    match = re.search(r'\.([^.]+)$', filename)
-    return match.group(1).lower() if match else "unknown"
+    """Extract file type (extension), e.g., pdf, xlsx, docx."""
+    _, dot, ext = filename.rpartition(".")
+    return ext.lower() if dot and ext else "unknown"
+
+
+# Docling converter of the current worker process and the pool's warmup barrier,
+# set by _init_docling_worker
+_worker_converter = None
+_worker_barrier = None
+
+# Seconds warmup waits for every Docling worker to finish loading its models
+DOCLING_WARMUP_TIMEOUT = 600
+
+
+def _build_converter(num_threads: int) -> DocumentConverter:
+    """Build the Docling PDF converter (OCR on every page)."""
+    ocr_options = TesseractCliOcrOptions(lang=["auto"])
+
+    # Threads for layout/table inference (Docling defaults to 4)
+    accelerator_options = AcceleratorOptions(num_threads=num_threads)
+
+    pipeline_options = PdfPipelineOptions(
+        do_ocr=True,
+        force_full_page_ocr=True,
+        ocr_options=ocr_options,
+        accelerator_options=accelerator_options,
+    )
+
+    return DocumentConverter(
+        format_options={
+            InputFormat.PDF: PdfFormatOption(
+                pipeline_options=pipeline_options
+            )
+        }
+    )
+
+
+def _init_docling_worker(num_threads: int, ready_barrier) -> None:
+    """Process pool initializer: build the converter and load its models once per worker."""
+    global _worker_converter, _worker_barrier
+    _worker_converter = _build_converter(num_threads)
+    _worker_converter.initialize_pipeline(InputFormat.PDF)
+    _worker_barrier = ready_barrier
+
+
+def _worker_ready(timeout: float) -> int:
+    """
+    Block until every worker runs this task. A worker can't take a second task while
+    waiting, so one task per worker is needed and each has loaded its models.
+    """
+    _worker_barrier.wait(timeout)
+    return os.getpid()
+
+
+def _docling_to_markdown(converter: DocumentConverter, file_path: str) -> Tuple[str, Dict[str, Any]]:
+    """Convert file → Markdown + basic metadata."""
+    conv = converter.convert(file_path)
+    markdown = conv.document.export_to_markdown()
+
+    metadata = {
+        "language": getattr(conv, "language", "auto")
+    }
+    return markdown, metadata
+
+
+def _convert_with_docling(file_path: str) -> Tuple[str, Dict[str, Any]]:
+    """Run in a worker process with the converter built by _init_docling_worker."""
+    return _docling_to_markdown(_worker_converter, file_path)
+
+
 class DocumentProcessor:
-    def __init__(self, config_file: str = "config.ini", profile: str = "DEFAULT"):
+    def __init__(
+        self,
+        config_file: str = "config.ini",
+        profile: str = "DEFAULT",
+        docling_workers: int | None = None,
+    ):
         """
         Initialize OCI Generative AI Client + Docling.
+        Docling runs in a pool of docling_workers processes (env DOCLING_WORKERS,
+        default up to 4); each worker loads its own copy of the models. With 0
+        workers Docling runs in this process instead.
         """
         if not Path(config_file).exists():
             raise FileNotFoundError("❌ config.ini not found. Please set up OCI credentials.")
@@ -51,6 +167,16 @@ class DocumentProcessor:
         # Service endpoint
         self.endpoint = "https://inference.generativeai.us-chicago-1.oci.oraclecloud.com"
 
+        # Chat model
+        self.model_id = "ocid1.generativeaimodel.oc1.us-chicago-1.amaaaaaask7dceya3bsfz4ogiuv3yc7gcnlry7gi3zzx6tnikg6jltqszm2q"
+
+        # Replies keyed by BLAKE2b(model_id + prompt), least recently used evicted first
+        self._llm_cache: OrderedDict[bytes, str] = OrderedDict()
+        self._llm_cache_lock = threading.Lock()
+
+        # Per-thread chat request templates, see _chat_template
+        self._chat_templates = threading.local()
+
         # OCI client
         self.client = oci.generative_ai_inference.GenerativeAiInferenceClient(
             config=self.config,
@@ -59,64 +185,167 @@ class DocumentProcessor:
             timeout=(10, 240)
         )
 
-        # Docling converter
-        ocr_options = TesseractCliOcrOptions(lang=["auto"])
-
-        pipeline_options = PdfPipelineOptions(
-            do_ocr=True,
-            force_full_page_ocr=True,
-            ocr_options=ocr_options,
+        # Docling converter pool: conversion is CPU-bound and would otherwise hold the GIL.
+        # 0 workers converts in-process, for hosts without multiprocessing support
+        self._cpu_count = os.cpu_count() or 1
+        if docling_workers is None:
+            docling_workers = int(os.environ.get("DOCLING_WORKERS", min(4, self._cpu_count)))
+        self.docling_workers = max(0, docling_workers)
+
+        self.converter = None
+        self._docling_pool = None
+        self._docling_pool_lock = threading.Lock()
+        if self.docling_workers:
+            try:
+                self._docling_pool = self._start_docling_pool()
+            except OSError as e:
+                # No POSIX semaphores (e.g. serverless hosts): same path as 0 workers
+                print(f"Docling process pool unavailable ({e}); converting in-process")
+                self.docling_workers = 0
+        if not self.docling_workers:
+            self.converter = _build_converter(self._cpu_count)
+
+    def _start_docling_pool(self) -> ProcessPoolExecutor:
+        # "spawn": forking a process that already has torch/OpenMP threads can deadlock
+        mp_context = multiprocessing.get_context("spawn")
+        return ProcessPoolExecutor(
+            max_workers=self.docling_workers,
+            mp_context=mp_context,
+            initializer=_init_docling_worker,
+            initargs=(
+                # Split the cores between workers instead of oversubscribing them
+                max(1, self._cpu_count // self.docling_workers),
+                mp_context.Barrier(self.docling_workers),
+            ),
         )
 
-        self.converter = DocumentConverter(
-            format_options={
-                InputFormat.PDF: PdfFormatOption(
-                    pipeline_options=pipeline_options
-                )
-            }
-        )
+    def _replace_docling_pool(self, broken_pool: ProcessPoolExecutor) -> None:
+        """Swap a broken pool for a fresh one (once, however many requests saw it break)."""
+        with self._docling_pool_lock:
+            if self._docling_pool is broken_pool:
+                broken_pool.shutdown(wait=False, cancel_futures=True)
+                self._docling_pool = self._start_docling_pool()
+
+    def warmup(self) -> None:
+        """
+        Load the Docling models before the first request: in-process, or in every
+        pool worker (one barrier-synchronised task each).
+        """
+        if self._docling_pool is None:
+            self.converter.initialize_pipeline(InputFormat.PDF)
+            return
+
+        pool = self._docling_pool
+        futures = [
+            pool.submit(_worker_ready, DOCLING_WARMUP_TIMEOUT)
+            for _ in range(self.docling_workers)
+        ]
+        try:
+            for future in futures:
+                future.result()
+        except BrokenProcessPool as e:
+            # A worker failed to start; requests get a fresh pool that loads lazily
+            print(f"Docling warmup failed: {e}")
+            self._replace_docling_pool(pool)
+        except threading.BrokenBarrierError:
+            print("Docling warmup timed out; remaining workers finish loading in the background")
+
+    def close(self) -> None:
+        """Stop the Docling worker processes."""
+        if self._docling_pool is not None:
+            self._docling_pool.shutdown(cancel_futures=True)
 
     def extract_with_docling(self, file_path: str) -> Tuple[str, Dict[str, Any]]:
         """
         Convert file → Markdown and return raw markdown + basic metadata.
         """
         try:
-            conv = self.converter.convert(file_path)
-            markdown = conv.document.export_to_markdown()
-
-            metadata = {
-                "language": getattr(conv, "language", "auto")
-            }
-            return markdown, metadata
+            if self._docling_pool is None:
+                return _docling_to_markdown(self.converter, file_path)
 
+            pool = self._docling_pool
+            try:
+                return pool.submit(_convert_with_docling, file_path).result()
+            except BrokenProcessPool:
+                # A worker died (OOM, crash on a bad file, failed model load): only this
+                # conversion fails, later uploads get a fresh pool
+                self._replace_docling_pool(pool)
+                raise
         except Exception as e:
             raise RuntimeError(f"Docling extraction failed: {e}")
 
 
     def _call_oci_llm(self, prompt: str) -> Tuple[str, int | None]:
-        """Call OCI Generative AI with a text prompt and return response text plus output tokens."""
-        content = oci.generative_ai_inference.models.TextContent()
+        """
+        Call OCI Generative AI with a text prompt and return response text plus output tokens.
+        Repeated prompts are answered from the in-process cache and report 0 output tokens.
+        """
+        key = self._llm_cache_key(prompt)
+        with self._llm_cache_lock:
+            cached = self._llm_cache.get(key)
+            if cached is not None:
+                self._llm_cache.move_to_end(key)
+                return cached, 0
+
+        text, output_tokens = self._request_oci_llm(prompt)
+
+        with self._llm_cache_lock:
+            self._llm_cache[key] = text
+            self._llm_cache.move_to_end(key)
+            while len(self._llm_cache) > LLM_CACHE_SIZE:
+                self._llm_cache.popitem(last=False)
+        return text, output_tokens
+
+    def _llm_cache_key(self, prompt: str) -> bytes:
+        return hashlib.blake2b(
+            f"{self.model_id}\n{prompt}".encode("utf-8"), digest_size=16
+        ).digest()
+
+    def _forget_llm_reply(self, prompt: str) -> None:
+        """Drop a cached reply the caller couldn't use, so a retry asks OCI again."""
+        with self._llm_cache_lock:
+            self._llm_cache.pop(self._llm_cache_key(prompt), None)
+
+    def _chat_template(self):
+        """
+        Return this thread's reusable ChatDetails and the TextContent holding its prompt.
+        Built once per worker thread, so concurrent calls never share a prompt slot.
+        """
+        template = getattr(self._chat_templates, "value", None)
+        if template is None:
+            content = oci.generative_ai_inference.models.TextContent()
+            message = oci.generative_ai_inference.models.Message()
+            message.role = "USER"
+            message.content = [content]
+
+            chat_request = oci.generative_ai_inference.models.GenericChatRequest()
+            chat_request.api_format = oci.generative_ai_inference.models.BaseChatRequest.API_FORMAT_GENERIC
+            chat_request.messages = [message]
+            chat_request.max_tokens = 2000
+            chat_request.temperature = 0
+            chat_request.top_p = 1
+            chat_request.top_k = 0
+
+            chat_detail = oci.generative_ai_inference.models.ChatDetails()
+            chat_detail.serving_mode = oci.generative_ai_inference.models.OnDemandServingMode(
+                model_id=self.model_id
+            )
+            chat_detail.chat_request = chat_request
+            chat_detail.compartment_id = self.compartment_id
+
+            template = (chat_detail, content)
+            self._chat_templates.value = template
+        return template
+
+    def _request_oci_llm(self, prompt: str) -> Tuple[str, int | None]:
+        """Send a chat request to OCI Generative AI and return response text plus output tokens."""
+        chat_detail, content = self._chat_template()
         content.text = prompt
-        message = oci.generative_ai_inference.models.Message()
-        message.role = "USER"
-        message.content = [content]
-
-        chat_request = oci.generative_ai_inference.models.GenericChatRequest()
-        chat_request.api_format = oci.generative_ai_inference.models.BaseChatRequest.API_FORMAT_GENERIC
-        chat_request.messages = [message]
-        chat_request.max_tokens = 2000
-        chat_request.temperature = 0
-        chat_request.top_p = 1
-        chat_request.top_k = 0
-
-        chat_detail = oci.generative_ai_inference.models.ChatDetails()
-        chat_detail.serving_mode = oci.generative_ai_inference.models.OnDemandServingMode(
-            model_id="ocid1.generativeaimodel.oc1.us-chicago-1.amaaaaaask7dceya3bsfz4ogiuv3yc7gcnlry7gi3zzx6tnikg6jltqszm2q"
-        )
-        chat_detail.chat_request = chat_request
-        chat_detail.compartment_id = self.compartment_id
-
-        response = self.client.chat(chat_detail)
+        try:
+            response = self.client.chat(chat_detail)
+        finally:
+            # Don't keep the (possibly large) prompt alive between calls
+            content.text = None
 
         output_tokens = None
         usage = getattr(getattr(response.data, "chat_response", None), "usage", None)
@@ -159,17 +388,19 @@ class DocumentProcessor:
                         return item.text.strip(), output_tokens
         raise RuntimeError("No valid response from OCI LLM")
 
-    def process_document(self, file_path: str) -> Dict[str, Any]:
+    def process_document(self, file_path: str, filename: str = None) -> Dict[str, Any]:
         """
         1. Docling → Markdown
-        2. Regex → File type
+        2. Extension → File type
         3. LLM → Extract language, client_name, layout
         4. Return markdown + metadata
+        filename is the original upload name (defaults to the basename of file_path);
+        it goes into the metadata prompt, so a temp-file name would defeat the LLM cache.
         """
         markdown, doc_metadata = self.extract_with_docling(file_path)
-        filename = os.path.basename(file_path)
+        filename = filename or os.path.basename(file_path)
 
-        # Extract file type using regex
+        # Extract file type from the extension
         file_type = get_file_type(filename)
 
         # LLM prompt to extract metadata
@@ -188,20 +419,22 @@ class DocumentProcessor:
         """
         raw_meta, _ = self._call_oci_llm(meta_prompt)
 
+        default_client = _STRIP_EXT_RE.sub("", filename)
         try:
-            meta_json = json.loads(raw_meta)
+            meta_json = load_json_safe(raw_meta)
         except:
+            self._forget_llm_reply(meta_prompt)
             meta_json = {
                 "language": doc_metadata.get("language", "NaN"),
                 "layout": [],
-                "client_name": re.sub(r"\..*$", "", filename),
+                "client_name": default_client,
             }
 
         normalized_meta = {
-            "file_type": file_type,  # from regex
+            "file_type": file_type,  # from filename extension
             "language": meta_json.get("language", doc_metadata.get("language", "NaN")),
             "layout": meta_json.get("layout", []),
-            "client_name": meta_json.get("client_name", re.sub(r"\..*$", "", filename)),
+            "client_name": meta_json.get("client_name", default_client),
         }
 
         return {
@@ -219,11 +452,9 @@ class DocumentProcessor:
         Apply schema to structured markdown and return JSON.
         If suggested_prompt is available, apply it along with the base schema extraction.
         """
-        # Create a sample JSON with empty values based on schema
-        sample_json = {}
-        for key in schema:
-            sample_json[key] = ""
-            
+        # Schema and a sample JSON with empty values based on it
+        schema_str, sample_str = format_schema(schema)
+
         if suggested_prompt:
             schema_prompt = f"""
     You are a document data extraction expert.
@@ -231,10 +462,10 @@ class DocumentProcessor:
     Use the following instruction to improve extraction: "{suggested_prompt}"
 
     Extract structured data from the document into JSON that EXACTLY follows this schema:
-    {json.dumps(schema, indent=2)}
+    {schema_str}
     
     Expected output format:
-    {json.dumps(sample_json, indent=2)}
+    {sample_str}
 
     Pay special attention to the Language field. It should be the primary language 
     used in the document content. Use ISO language codes (e.g., 'en' for English, 
@@ -288,10 +519,10 @@ class DocumentProcessor:
     
     Extract structured data from the following document into JSON.
     The JSON must EXACTLY follow this schema with these exact field names:
-    {json.dumps(schema, indent=2)}
+    {schema_str}
     
     Expected output format:
-    {json.dumps(sample_json, indent=2)}
+    {sample_str}
 
     Pay special attention to the Language field. It should be the primary language 
     used in the document content. Use ISO language codes (e.g., 'en' for English, 
@@ -345,13 +576,8 @@ class DocumentProcessor:
         raw_json, output_tokens = self._call_oci_llm(schema_prompt)
 
         try:
-            # Clean the response to ensure it's valid JSON
-            cleaned_json = raw_json.strip()
-            # Remove any markdown code block indicators
-            cleaned_json = re.sub(r'^```json\s*', '', cleaned_json)
-            cleaned_json = re.sub(r'\s*```$', '', cleaned_json)
-            
-            parsed_json = json.loads(cleaned_json)
+            # Any markdown code block indicators around the JSON are skipped
+            parsed_json = load_json_safe(raw_json)
             
             # Ensure all schema keys are present
             for key in schema:
@@ -360,13 +586,15 @@ class DocumentProcessor:
                     
             return parsed_json, output_tokens
         except Exception as e:
+            self._forget_llm_reply(schema_prompt)
             return {"error": f"Failed to parse JSON: {str(e)}", "raw": raw_json}, output_tokens
 
     def find_suggested_prompt(self, current_client: str, current_layout: str, cursor) -> str:
         """
         Find suggested prompt by:
         1. First checking for exact client name match
-        2. Then using LLM to compare layouts for similarity
+        2. Then comparing layouts: identical column sets match directly, the rest are
+           scored for similarity by the LLM in one batched call
         """
         # Step 1: Check for exact client name match first
         cursor.execute(
@@ -377,49 +605,78 @@ class DocumentProcessor:
         if row:
             return row[0]
         
-        # Step 2: Get all documents with saved prompts for layout comparison
+        # Step 2: Get one saved prompt per distinct layout for comparison
+        # (earliest row wins, as it did when every row was scored)
         cursor.execute(
-            "SELECT client_name, layout, user_prompt FROM documents WHERE user_prompt IS NOT NULL"
+            """
+            SELECT layout, user_prompt, MIN(id) FROM documents
+            WHERE user_prompt IS NOT NULL
+            GROUP BY layout
+            ORDER BY MIN(id)
+            """
         )
         candidates = cursor.fetchall()
         
         if not candidates:
             return None
             
-        # Step 3: Use LLM to find the most similar layout
+        # Step 3: An identical layout (after normalizing) needs no LLM comparison
         current_layout_parsed = json.loads(current_layout) if isinstance(current_layout, str) else current_layout
-        
+        current_columns = _normalize_layout(current_layout_parsed)
+
+        comparable = []
+        for candidate_layout, candidate_prompt, _ in candidates:
+            try:
+                candidate_layout_parsed = json.loads(candidate_layout) if isinstance(candidate_layout, str) else candidate_layout
+            except Exception:
+                # Skip this candidate if its stored layout is unreadable
+                continue
+            if current_columns and _normalize_layout(candidate_layout_parsed) == current_columns:
+                return candidate_prompt
+            comparable.append((candidate_layout_parsed, candidate_prompt))
+
+        if not comparable:
+            return None
+
+        # Step 4: Score every candidate layout in a single LLM call
+        candidate_lines = "\n".join(
+            f"{i}. {json.dumps(layout)}" for i, (layout, _) in enumerate(comparable, 1)
+        )
+        comparison_prompt = f"""
+        Compare the current document layout with each candidate layout and give each candidate a similarity score from 0 to 100.
+        Consider column names, data types, and overall structure.
+        Return ONLY a JSON object mapping each candidate number to its score, no explanations:
+        {{"1": <score>, "2": <score>, ...}}
+
+        Current layout: {json.dumps(current_layout_parsed)}
+
+        Candidate layouts:
+        {candidate_lines}
+
+        Similarity scores (JSON object):
+        """
+
+        try:
+            score_text, _ = self._call_oci_llm(comparison_prompt)
+            scores = load_json_safe(score_text)
+        except Exception:
+            self._forget_llm_reply(comparison_prompt)
+            return None
+        if not isinstance(scores, dict):
+            self._forget_llm_reply(comparison_prompt)
+            return None
+
         best_prompt = None
         best_similarity_score = 0
-        
-        for candidate_client, candidate_layout, candidate_prompt in candidates:
+
+        # Scores are looked up by candidate number, so a dropped or extra entry
+        # can't shift them onto the wrong candidate
+        for i, (_, candidate_prompt) in enumerate(comparable, 1):
             try:
-                candidate_layout_parsed = json.loads(candidate_layout) if isinstance(candidate_layout, str) else candidate_layout
-                
-                # Use LLM to compare layouts
-                comparison_prompt = f"""
-                Compare these two document layouts and return a similarity score from 0 to 100.
-                Consider column names, data types, and overall structure.
-                Return ONLY a number between 0-100, no explanations.
-                
-                Layout 1: {json.dumps(current_layout_parsed)}
-                Layout 2: {json.dumps(candidate_layout_parsed)}
-                
-                Similarity score (0-100):
-                """
-                
-                score_text, _ = self._call_oci_llm(comparison_prompt)
-                
-                # Extract numeric score
-                import re
-                score_match = re.search(r'\b(\d+(?:\.\d+)?)\b', score_text)
-                if score_match:
-                    similarity_score = float(score_match.group(1))
-                    if similarity_score > best_similarity_score and similarity_score >= 70:  # Threshold for similarity
-                        best_similarity_score = similarity_score
-                        best_prompt = candidate_prompt
-                        
-            except Exception as e:
-                # Skip this candidate if there's an error
+                similarity_score = float(scores[str(i)])
+            except (KeyError, TypeError, ValueError):
                 continue
+            if similarity_score > best_similarity_score and similarity_score >= 70:  # Threshold for similarity
+                best_similarity_score = similarity_score
+                best_prompt = candidate_prompt
         return best_prompt
\ No newline at end of file